@@ -0,0 +1,18 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+# distutils: extra_compile_args = -O3 -march=native -ffast-math -fopenmp
+# distutils: extra_link_args = -fopenmp
+'''
+Compiled kernel for the 2x2 affine transform of **CoordinateTransform**.  Optional,
+build in place with ``cythonize -i meglib/_ct.pyx``; baselib falls back to numpy
+when it is not built.
+'''
+from cython.parallel import prange
+
+cpdef void affine2d(const double[:, ::1] pts, const double[:, ::1] A, const double[::1] b, double[:, ::1] out) noexcept nogil:
+    '''
+    sets ``out[i] = A.pts[i] + b`` for the *N* x 2 array of points *pts*
+    '''
+    cdef Py_ssize_t i
+    for i in prange(pts.shape[0]):
+        out[i,0] = A[0,0]*pts[i,0] + A[0,1]*pts[i,1] + b[0]
+        out[i,1] = A[1,0]*pts[i,0] + A[1,1]*pts[i,1] + b[1]
@@ -31,16 +31,48 @@ for licence (MIT) see LICENSE.txt
 '''
 
 import os, sys, errno
+import io
 from os.path import expanduser, join
 import shutil
 import time
 import inspect
+import struct
+import zipfile
 import numpy as np
-import matplotlib.pyplot as plt
+from numpy.lib import format as npy_format
 
 from traits.api import HasTraits, CFloat, CInt, Property, Range, Instance, Enum
 from traits.api import Str, Array, List, Button, File, Directory, Dict, Bool, CStr
 
+# default print/output variable lists, keyed by (class, 'print' or 'output', excluded variables)
+_defaults_cache = {}
+
+# hidden variables that are never in the default print/output variable lists
+_PRINT_SKIP = frozenset(['output_variables', 'print_variables', 'edit_exclude_variables', 
+                         'app_type', 'app_version', 'app_version_number', 'run_name'])
+_OUTPUT_SKIP = frozenset(['output_variables', 'print_variables', 'edit_exclude_variables', 
+                          'parm_file', 'run_name'])
+
+def _fast_npz_iter(path):
+    '''
+    Yields the ``(name, array)`` pairs of the NPZ file *path*.  Stored (uncompressed)
+    members are read straight from the archive file at their data offset, compressed
+    members fall back to the normal zip stream.
+    '''
+    pickle_kwargs = dict(encoding='ASCII', fix_imports=True)
+    with zipfile.ZipFile(path) as zf:
+        for member, info in zf.NameToInfo.items():
+            name = member[:-4] if member.endswith('.npy') else member
+            if info.compress_type == zipfile.ZIP_STORED:
+                # local file header is 30 bytes + file name + extra field
+                zf.fp.seek(info.header_offset + 26)
+                name_len, extra_len = struct.unpack('<HH', zf.fp.read(4))
+                zf.fp.seek(info.header_offset + 30 + name_len + extra_len)
+                yield name, npy_format.read_array(zf.fp, allow_pickle=True, pickle_kwargs=pickle_kwargs)
+            else:
+                with zf.open(info) as f:
+                    yield name, npy_format.read_array(f, allow_pickle=True, pickle_kwargs=pickle_kwargs)
+
 class AppRunner(HasTraits):
     '''
     Class to run the application
@@ -72,8 +104,8 @@ class AppRunner(HasTraits):
         if not not parm_file:
             self.parm_file = parm_file
             self.load()
-        for name in p:
-            setattr(self, name, p[name])
+        if p:
+            self.trait_set(**p)
     
     def __str__(self, space=''):
         if not self.print_variables:
@@ -96,47 +128,37 @@ class AppRunner(HasTraits):
         Returns default variables to print and edit, and excludes the list
         of variables *exclude* from the list
         '''
-        print_variables = self.editable_traits()
-        print_variables.remove('output_variables')
-        print_variables.remove('print_variables')
-        print_variables.remove('edit_exclude_variables')
-        print_variables.remove('app_type')
-        print_variables.remove('app_version')
-        print_variables.remove('app_version_number')
-        print_variables.remove('run_name')
-        for variable in exclude:
-            if variable in print_variables:
-                print_variables.remove(variable)
-        return print_variables
+        key = (type(self), 'print', tuple(sorted(exclude)))
+        if key in _defaults_cache:
+            return list(_defaults_cache[key])
+        exclude_set = frozenset(exclude)
+        print_variables = [name for name in self.editable_traits() 
+                           if name not in _PRINT_SKIP and name not in exclude_set]
+        _defaults_cache[key] = print_variables
+        return list(print_variables)
         
     def default_output_variables(self, exclude=[]):
         '''
         Returns the default variables to output to the saved state, and excludes 
         the list of variables *exclude* from the list
         '''
-        output_variables = self.editable_traits()
-        output_variables.remove('output_variables')
-        output_variables.remove('print_variables')
-        output_variables.remove('edit_exclude_variables')
-        output_variables.remove('parm_file')
-        output_variables.remove('run_name')
-        for variable in exclude:
-            if variable in output_variables:
-                output_variables.remove(variable)
-        return output_variables
+        key = (type(self), 'output', tuple(sorted(exclude)))
+        if key in _defaults_cache:
+            return list(_defaults_cache[key])
+        exclude_set = frozenset(exclude)
+        output_variables = [name for name in self.editable_traits() 
+                            if name not in _OUTPUT_SKIP and name not in exclude_set]
+        _defaults_cache[key] = output_variables
+        return list(output_variables)
     
     def save_figs(self, name=None):
         '''
         Saves all the open figs to the *output_directory* in PNG format with a root
         name of *name*
         '''
-        if not name:
-            file_root = 'fig'
-        else:
-            file_root = name + '_fig'
-        for i in plt.get_fignums():
-            plt.figure(i)
-            plt.savefig(expanduser(join(self.output_directory, file_root + '_%d.png' % i )))
+        from meglib.baselib import save_figs
+        
+        save_figs(self.output_directory, name or '')
        
     def default_output_path(self, create_only=False, output_directory=None):
         '''
@@ -189,10 +211,23 @@ class AppRunner(HasTraits):
         else:
             output_variables = self.output_variables
         
-        save_list = {}    
-        for name in output_variables:
-            save_list[name] = getattr(self, name)
-        np.savez(str(expanduser(parm_file)), **save_list)
+        # write the NPY members directly into a stored (uncompressed) zip, same layout as np.savez,
+        # assembled in memory so the file is written in one go
+        parm_file = str(expanduser(parm_file))
+        if not parm_file.endswith('.npz'):
+            parm_file += '.npz'
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+            for name in output_variables:
+                value = getattr(self, name)
+                try:
+                    arr = np.asanyarray(value)
+                except ValueError:
+                    arr = np.asanyarray(value, dtype=object)
+                with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                    npy_format.write_array(f, arr, version=(3,0), allow_pickle=True)
+        with open(parm_file, 'wb') as f:
+            f.write(buf.getbuffer())
         
     def load(self, parm_file=None):
         '''
@@ -206,25 +241,20 @@ class AppRunner(HasTraits):
         else:
             self.parm_file = parm_file
 
-        data = np.load(str(expanduser(parm_file)), allow_pickle=True)
         data_dict = {}
-        for attribute, value in data.items():
-            # print(attribute, value.tolist())
-            if isinstance(value.tolist(), bytes):
-                # print('decoding ' + attribute + ' . . .')
-                data_dict[attribute] = str(value.tolist().decode())
-                # print(attribute, data_dict[attribute])
-            else:
-                data_dict[attribute] = value.tolist()
-            if isinstance(data_dict[attribute], list):
-                for i1, element_1 in enumerate(data_dict[attribute]):
+        for attribute, value in _fast_npz_iter(str(expanduser(parm_file))):
+            value = value.tolist()
+            if isinstance(value, bytes):
+                value = str(value.decode())
+            elif isinstance(value, list):
+                for i1, element_1 in enumerate(value):
                     if isinstance(element_1, list):
                         for i2, element_2 in enumerate(element_1):
                             if isinstance(element_2, bytes):
-                                data_dict[attribute][i1][i2] = str(element_2.decode())
+                                element_1[i2] = str(element_2.decode())
                     elif isinstance(element_1, bytes):
-                        data_dict[attribute][i1] = str(element_1.decode())
-            setattr(self, attribute, data_dict[attribute])
+                        value[i1] = str(element_1.decode())
+            data_dict[attribute] = value
             
         if not ('app_type' in data_dict):
             data_dict['app_type'] = self.app_type
@@ -235,8 +265,8 @@ class AppRunner(HasTraits):
         if self.app_type == data_dict['app_type']:
             if self.app_version != data_dict['app_version']:
                 self.convert_parm(data_dict)
-            for attribute, value in data.items():
-                setattr(self, attribute, data_dict[attribute])
+            self.trait_set(**{attribute: value for attribute, value in data_dict.items() 
+                              if self.trait(attribute) is not None})
         else:
             print('Not able to load parameters. Wrong app_type ' + data_dict['app_type'])
     
@@ -422,6 +452,8 @@ class DemoApp(AppRunner):
         print(self.parm1, self.parm2, self.parm3, self.parm_new)
         
     def plot(self):
+        import matplotlib.pyplot as plt
+        
         x = np.linspace(0.0,5.0,50)
         y = self.parm1 * x * x - self.parm_new * x
         
@@ -3,10 +3,47 @@ Basic utility functions.  Written by Michael Glinsky.
 '''
 import numpy as np
 from scipy import linalg
-import os.path
+import io
+import mmap
 import pickle
+import struct
 import zipfile
-from copy import deepcopy
+# compiled affine kernel for CoordinateTransform, loaded on first use (None if neither
+# the Cython extension nor numba is available); only used from _AFFINE2D_MIN_POINTS points
+_affine2d = False
+_AFFINE2D_MIN_POINTS = 256
+
+def _get_affine2d():
+    global _affine2d
+    if _affine2d is False:
+        try:
+            from meglib._ct import affine2d as _affine2d
+        except ImportError:
+            try:
+                from numba import njit, prange
+            except ImportError:
+                _affine2d = None
+            else:
+                # no explicit signature, so read-only inputs get their own specialization
+                @njit(parallel=True, fastmath=True, cache=True)
+                def affine2d(pts, A, b, out):
+                    for i in prange(pts.shape[0]):
+                        out[i,0] = A[0,0]*pts[i,0] + A[0,1]*pts[i,1] + b[0]
+                        out[i,1] = A[1,0]*pts[i,0] + A[1,1]*pts[i,1] + b[1]
+                _affine2d = affine2d
+    return _affine2d
+
+# optional blosc2 module, imported on first use (None if not installed)
+_blosc2 = False
+
+def _get_blosc2():
+    global _blosc2
+    if _blosc2 is False:
+        try:
+            import blosc2 as _blosc2
+        except ImportError:
+            _blosc2 = None
+    return _blosc2
 
 class AttrDict(dict):
     '''
@@ -14,8 +51,9 @@ class AttrDict(dict):
     a group of parameters.
     ``my_attrdict.__class__.__name__ = 'AttrDict'``;  after read with old class
     '''
-    def __getattr__(self, k): return self[k]
-    def __setattr__(self, k, v): self[k] = v
+    # bound to the C dict slots directly, so attribute access does not go through a Python frame
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
     
 def append_list(base_list, add_list, name_list):
     '''
@@ -24,64 +62,146 @@ def append_list(base_list, add_list, name_list):
     for name in add_list:
         base_list.append(name + '_' + name_list)
         
+def _write_zip_member(myzip, arcname, data, typesize=1, use_blosc2=False):
+    '''
+    write *data* to *arcname* in *myzip*, compressed with blosc2 (stored as *arcname*.blosc2)
+    if *use_blosc2* and it is available, otherwise with the zip's own compression
+    '''
+    blosc2 = _get_blosc2() if use_blosc2 else None
+    if blosc2 is not None and len(data) <= blosc2.MAX_BUFFERSIZE:
+        # blosc2 only takes a typesize up to 255 that divides the data length
+        if typesize > 255 or len(data) % typesize != 0:
+            typesize = 1
+        packed = blosc2.compress(data, typesize=typesize, clevel=5, codec=blosc2.Codec.LZ4)
+        myzip.writestr(arcname + ".blosc2", packed, zipfile.ZIP_STORED)
+    else:
+        myzip.writestr(arcname, data)
+        
+def _read_zip_member(myzip, arcname, mm):
+    '''
+    read *arcname* from *myzip* as a bytearray, decompressing it if it was written with blosc2.
+    blosc2 members are stored uncompressed in the zip, so they are decompressed straight from
+    the memory map *mm* of the archive file.
+    '''
+    info = myzip.NameToInfo.get(arcname + ".blosc2")
+    if info is None:
+        return bytearray(myzip.read(arcname))
+    blosc2 = _get_blosc2()
+    if blosc2 is None:
+        raise ImportError("blosc2 is needed to read " + arcname + " from " + myzip.filename)
+    # local file header is 30 bytes + file name + extra field
+    name_len, extra_len = struct.unpack_from('<HH', mm, info.header_offset + 26)
+    start = info.header_offset + 30 + name_len + extra_len
+    with memoryview(mm) as view, view[start:start + info.compress_size] as packed:
+        return blosc2.decompress(packed, as_bytearray=True)
+        
 def read_pickled_object(filename, file_extension):
     '''
     read a object from a zipped Pickle file of the object. *filename* is the root
     filename that will be read which will have *file_extension* added to it.
     '''
-    (path, name) = os.path.split(filename)
-    cwd = os.getcwd()
-    if path == '':
-        pass
-    else:
-        os.chdir(path)
-    
-    with zipfile.ZipFile(name + "." + file_extension, 'r') as myzip:
-        myzip.extractall()
-    
-    with open("obj.tmp.pickle", "rb") as f:
-        obj = pickle.load(f)
-            
-    os.remove("obj.tmp.pickle")
-    os.chdir(cwd)
+    with zipfile.ZipFile(filename + "." + file_extension, 'r') as myzip, \
+         mmap.mmap(myzip.fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        n_buffers = len([name for name in myzip.namelist() if name.startswith("obj.tmp.buffer_")])
+        buffers = [_read_zip_member(myzip, "obj.tmp.buffer_%d" % i, mm) for i in range(n_buffers)]
+        obj = pickle.loads(_read_zip_member(myzip, "obj.tmp.pickle", mm), buffers=buffers)
     
     return obj
     
-def write_pickled_object(obj, filename, file_extension):
+def write_pickled_object(obj, filename, file_extension, use_blosc2=False, out_of_band_bytes=65536):
     '''
-    write an *obj* to a zipped Pickle file with *filename* and *file_extension*
+    write an *obj* to a zipped Pickle file with *filename* and *file_extension*.
+    Contiguous buffers (e.g. numpy arrays) of at least *out_of_band_bytes* are pickled
+    out-of-band and stored as separate ``obj.tmp.buffer_i`` members.  The members are compressed
+    with DEFLATE, or with blosc2 if *use_blosc2* and it is installed; such files
+    can only be read back where blosc2 is installed.
     '''
-    (path, name) = os.path.split(filename)
-    cwd = os.getcwd()
-    if path == '':
-        pass
-    else:
-        os.chdir(path)
-        
-    with open("obj.tmp.pickle", "wb") as f:
-        pickle.dump(obj, f)
-        
-    with zipfile.ZipFile(name + "." + file_extension, 'w', zipfile.ZIP_DEFLATED) as myzip:
-        myzip.write("obj.tmp.pickle")
+    buf = io.BytesIO()
+    buffers = []
+    def buffer_callback(buffer):
+        # returning True keeps a small buffer in the pickle stream
+        if memoryview(buffer).nbytes < out_of_band_bytes:
+            return True
+        buffers.append(buffer)
+        return False
+    pickle.dump(obj, buf, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffer_callback)
         
-    os.remove("obj.tmp.pickle")
-    os.chdir(cwd)
+    with zipfile.ZipFile(filename + "." + file_extension, 'w', zipfile.ZIP_DEFLATED) as myzip:
+        _write_zip_member(myzip, "obj.tmp.pickle", buf.getbuffer(), use_blosc2=use_blosc2)
+        for i, buffer in enumerate(buffers):
+            _write_zip_member(myzip, "obj.tmp.buffer_%d" % i, buffer.raw(), memoryview(buffer).itemsize, 
+                              use_blosc2=use_blosc2)
+    
+def test_pickled_object(filename=None):
+    '''
+    Round trips some objects through write_pickled_object() and read_pickled_object(),
+    with and without blosc2, to *filename* (default ~/tmp/test_pickle)
+    '''
+    from os.path import expanduser, join
+    
+    if not filename:
+        filename = expanduser(join('~','tmp','test_pickle'))
+    wide = np.zeros(5, dtype=[('a','f8',(40,))])    # itemsize 320 > blosc2's largest typesize
+    wide['a'] = np.arange(200.).reshape(5,40)
+    obj = AttrDict(wide=wide, big=np.arange(100000.), small=np.arange(3), text='text')
+    for use_blosc2 in (False, True):
+        write_pickled_object(obj, filename, 'zpk', use_blosc2=use_blosc2)
+        new_obj = read_pickled_object(filename, 'zpk')
+        assert new_obj.text == obj.text
+        for name in ('wide', 'big', 'small'):
+            assert np.array_equal(new_obj[name], obj[name])
+    
+def _write_png(filename, rgba, dpi, software):
+    '''
+    write the rendered *rgba* image array of a figure to the PNG file *filename*,
+    with the same ``dpi`` and ``Software`` metadata that matplotlib writes
+    '''
+    from PIL import Image
+    from PIL.PngImagePlugin import PngInfo
+    
+    info = PngInfo()
+    info.add_text('Software', software)
+    Image.fromarray(rgba, 'RGBA').save(filename, 'PNG', dpi=(dpi, dpi), pnginfo=info)
     
 def save_figs(path='', name=''):
     '''
-    save all open figures to *path* + *name* _fig_i.png
+    save all open figures to *path* + *name* _fig_i.png.  The figures are rendered
+    in turn with savefig and the PNG encoding and writing is done in a thread pool.
     '''
+    import matplotlib
     import matplotlib.pyplot as plt
     from os.path import join, expanduser
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    
+    if name == '':
+        file_root = 'fig'
+    else:
+        file_root = name + '_fig'
+    software = 'Matplotlib version' + matplotlib.__version__ + ', https://matplotlib.org/'
+    
+    with ThreadPoolExecutor() as executor:
+        futures = []
+        for i in plt.get_fignums():
+            fig = plt.figure(i)
+            filename = expanduser(join(path, file_root + '_%d.png' % i))
+            # a tight bbox changes the image size, so leave that case to savefig
+            if matplotlib.rcParams['savefig.bbox'] != 'tight':
+                dpi = matplotlib.rcParams['savefig.dpi']
+                if dpi == 'figure':
+                    dpi = fig.dpi
+                # matplotlib is not thread safe, so render here (applying the savefig rcParams)
+                # and only encode in the pool
+                buf = io.BytesIO()
+                fig.savefig(buf, format='rgba', dpi=dpi)
+                width, height = int(fig.get_figwidth()*dpi), int(fig.get_figheight()*dpi)
+                if buf.tell() == width*height*4:
+                    rgba = np.frombuffer(buf.getvalue(), dtype=np.uint8).reshape(height, width, 4)
+                    futures.append(executor.submit(_write_png, filename, rgba, dpi, software))
+                    continue
+            plt.savefig(filename)
+        for future in as_completed(futures):
+            future.result()
     
-    for i in plt.get_fignums():
-        plt.figure(i)
-       	if name == '':
-       	    file_root = 'fig'
-       	else:
-       	    file_root = name + '_fig'
-       	plt.savefig(expanduser(join(path, file_root + '_%d.png' % i)))
-   	
 def test_path(fname, test_directory='~/code/pysnl/run_parameters'):
     '''
     form expanded path for *test_directory* / *fname*
@@ -95,12 +215,91 @@ class CoordinateTransform:
     data model for a coordinate transform between ``(i,j)`` and ``(x,y)``
     '''
     def __init__(self):
-        self.A = np.identity(2)
-        self.b = np.zeros(2)
-        self.A_inv = linalg.inv(self.A)
-        self.b_inv = - self.A_inv.dot(self.b)
+        # A and b are views into one buffer, ``_state = [A.ravel(), b]``, as is the inverse in _inv_state.
+        # The views are made once, in _set_state and _compute_inv, and stored as _A, _b, _A_inv and _b_inv.
+        self._set_state(np.concatenate([np.identity(2).ravel(), np.zeros(2)]))
         self.utm = ""
         
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ('_A', '_b', '_inv_state', '_A_inv', '_b_inv'):
+            state.pop(name, None)
+        return state
+        
+    def __setstate__(self, state):
+        # older pickles carry A and b (and possibly their inverses) as separate arrays
+        if '_state' not in state:
+            A = state.pop('A', state.pop('_A', None))
+            b = state.pop('b', state.pop('_b', None))
+            state['_state'] = np.concatenate([np.ravel(A), np.ravel(b)]).astype(np.float64)
+        for name in ('A_inv', 'b_inv', '_A', '_b', '_inv_state', '_A_inv', '_b_inv'):
+            state.pop(name, None)
+        self.__dict__.update(state)
+        self._set_state(self._state)
+        
+    def _set_state(self, state):
+        '''
+        replaces the buffer holding *A* and *b*, and drops the cached inverse
+        '''
+        self._state = state
+        # read-only, so in-place edits can not leave the cached inverse stale; assign A or b instead
+        self._A = state[:4].reshape(2,2)
+        self._b = state[4:]
+        self._A.flags.writeable = self._b.flags.writeable = False
+        self._inv_state = None
+        
+    @property
+    def A(self):
+        return self._A
+        
+    @A.setter
+    def A(self, A):
+        # a new buffer, so views handed out before are not changed underneath the caller
+        state = np.empty(6)
+        state[:4] = np.ravel(A)
+        state[4:] = self._state[4:]
+        self._set_state(state)
+        
+    @property
+    def b(self):
+        return self._b
+        
+    @b.setter
+    def b(self, b):
+        state = np.empty(6)
+        state[:4] = self._state[:4]
+        state[4:] = b
+        self._set_state(state)
+        
+    @property
+    def A_inv(self):
+        if self._inv_state is None:
+            self._compute_inv()
+        return self._A_inv
+        
+    @property
+    def b_inv(self):
+        if self._inv_state is None:
+            self._compute_inv()
+        return self._b_inv
+        
+    def _compute_inv(self):
+        '''
+        computes the inverse transform with the closed form 2x2 inverse of *A*
+        '''
+        a11, a12, a21, a22, b1, b2 = self._state
+        det = a11*a22 - a12*a21
+        if det == 0:
+            raise np.linalg.LinAlgError('Singular matrix')
+        inv_state = np.empty(6)
+        inv_state[:4] = (a22/det, -a12/det, -a21/det, a11/det)
+        inv_state[4] = - (inv_state[0]*b1 + inv_state[1]*b2)
+        inv_state[5] = - (inv_state[2]*b1 + inv_state[3]*b2)
+        self._inv_state = inv_state
+        self._A_inv = inv_state[:4].reshape(2,2)
+        self._b_inv = inv_state[4:]
+        self._A_inv.flags.writeable = self._b_inv.flags.writeable = False
+        
     def my_str(self, space=''):
         string = ""
         string += space + "A =" + "\n"
@@ -113,10 +312,7 @@ class CoordinateTransform:
         return self.my_str()
         
     def __eq__(self, other):
-        if (self.A == other.A).all() and (self.b == other.b).all():
-            return True
-        else:
-            return False
+        return bool(np.array_equal(self._state, other._state))
         
     def three_point_set(self, x_y_points, i_j_points, utm = ""):
         '''
@@ -126,92 +322,102 @@ class CoordinateTransform:
         '''
         self.utm = utm
         
-        dx = np.array([np.array(x_y_points[2]) - np.array(x_y_points[0]), np.array(x_y_points[1]) - np.array(x_y_points[0])])
-        ds = np.array([np.array(i_j_points[2]) - np.array(i_j_points[0]), np.array(i_j_points[1]) - np.array(i_j_points[0])])
+        xy = np.asarray(x_y_points, dtype=float)
+        ij = np.asarray(i_j_points, dtype=float)
+        dx = np.column_stack([xy[2] - xy[0], xy[1] - xy[0]])
+        ds = np.column_stack([ij[2] - ij[0], ij[1] - ij[0]])
         
-        dx = dx.T
-        ds = ds.T
+        # A.ds = dx
+        self.A = linalg.solve(ds.T, dx.T).T
+        self.b = xy[0] - self.A.dot(ij[0])
         
-        self.A = dx.dot(linalg.inv(ds))
-        self.b = x_y_points[0] - self.A.dot(ep_cdp_points[0])
-        self.A_inv = linalg.inv(self.A)
-        self.b_inv = - self.A_inv.dot(self.b)
+    def _apply(self, mat, off, pts):
+        '''
+        applies the affine transform ``mat.pts + off`` to points *pts* of shape ``(...,2)``
+        '''
+        pts = np.asarray(pts)
+        if pts.ndim == 1:
+            return mat.dot(pts) + off
+        if pts.size < 2*_AFFINE2D_MIN_POINTS:
+            return np.matmul(pts, mat.T) + off
+        affine2d = _get_affine2d()
+        if affine2d is None:
+            return np.matmul(pts, mat.T) + off
+        if pts.shape[-1] != 2:
+            raise ValueError('points must have shape (...,2), not ' + str(pts.shape))
+        pts = np.ascontiguousarray(pts, dtype=np.float64)
+        out = np.empty_like(pts)
+        affine2d(pts.reshape(-1,2), np.ascontiguousarray(mat, dtype=np.float64), 
+                  np.ascontiguousarray(off, dtype=np.float64), out.reshape(-1,2))
+        return out
         
     def x_y(self, i_j):
         '''
         returns an ``(x,y)`` point given a ``(i,j)`` point
         '''
-        return self.A.dot(i_j) + self.b
+        return self._A.dot(i_j) + self._b
         
     def i_j(self, x_y):
         '''
         returns a ``(i,j)`` point given an ``(x,y)`` point
         '''
-        return self.A_inv.dot(x_y) + self.b_inv
+        if self._inv_state is None:
+            self._compute_inv()
+        return self._A_inv.dot(x_y) + self._b_inv
         
     def x_y_T(self, ep_cdp):
         '''
         returns an ``(x,y)`` point given a ``(i,j)`` point
         '''
-        return np.array(ep_cdp).dot(self.A.T) + self.b
+        return self._apply(self.A, self.b, ep_cdp)
         
     def i_j_T(self, x_y):
         '''
         returns a ``(i,j)`` point given an ``(x,y)`` point
         '''
-        return np.array(x_y).dot(self.A_inv.T) + self.b_inv
+        return self._apply(self.A_inv, self.b_inv, x_y)
         
     def x_y_array(self, i, j):
         '''
         returns arrays of the x and y coordinates given arrays of the ep and
         cdp coordinates
         '''
-        s = np.array([i,j])
-        x = (s.T.dot(self.A.T) + self.b).T
-        return x[0,:,:], x[1,:,:]
+        x = self._apply(self.A, self.b, np.stack([i,j], axis=-1))
+        return x[...,0], x[...,1]
         
     def i_j_array(self, x_in, y_in):
         '''
         returns arrays of the ep and cdp coordinates given arrays of the x and
         y coordinates
         '''
-        x = np.array([x_in,y_in])
-        s = (x.T.dot(self.A_inv.T) + self.b_inv).T
-        return s[0,:,:], s[1,:,:]
+        s = self._apply(self.A_inv, self.b_inv, np.stack([x_in,y_in], axis=-1))
+        return s[...,0], s[...,1]
         
     def x_y_vector(self, ep, cdp):
         '''
         returns vectors of the x and y coordinates given vectors of the ep and
         cdp coordinates
         '''
-        s = np.array([ep,cdp])
-        x = (s.T.dot(self.A.T) + self.b).T
-        return x[0,:], x[1,:]
+        return self.x_y_array(ep, cdp)
         
     def i_j_vector(self, x_in, y_in):
         '''
         returns vectors of the i and j coordinates given vectors of the x and
         y coordinates
         '''
-        x = np.array([x_in,y_in])
-        s = (x.T.dot(self.A_inv.T) + self.b_inv).T
-        return s[0,:], s[1,:]
+        return self.i_j_array(x_in, y_in)
         
     def clone(self):
         new_transform = CoordinateTransform()
         
-        new_transform.A = deepcopy(self.A)
-        new_transform.b = deepcopy(self.b)
-        new_transform.A_inv = deepcopy(self.A_inv)
-        new_transform.b_inv = deepcopy(self.b_inv)
+        new_transform.A = self.A.copy()
+        new_transform.b = self.b.copy()
         
         return new_transform
             
     def copy_obj(self, old_transform):
-        self.A = deepcopy(old_transform.A)
-        self.b = deepcopy(old_transform.b)
-        self.A_inv = deepcopy(old_transform.A_inv)
-        self.b_inv = deepcopy(old_transform.b_inv)
+        self.A = old_transform.A.copy()
+        self.b = old_transform.b.copy()
         
         return self
             